@@ -1,6 +1,5 @@
 """Simple in memory caching"""
 import logging
-from collections import OrderedDict
 
 __all__ = ('LRUCache',)
 
@@ -16,10 +15,33 @@ class _EntryMissing(object):
 _MISSING = _EntryMissing()
 
 
-class LRUCache:
-    """Fixed size LRUCache backed by an OrderedDict.
+class _Entry(object):
+    """A cached value and whether it was read since it was last
+    considered for eviction."""
+    __slots__ = ('value', 'referenced')
+
+    def __init__(self, value):
+        self.value = value
+        self.referenced = False
+
+    def __repr__(self):
+        return '<Entry: {!r}>'.format(self.value)
 
-    .. note:: LRUCache is not thread safe.
+
+class LRUCache:
+    """Fixed size LRUCache backed by a dict. Dicts preserve insertion
+    order, so the first key is always the oldest entry.
+
+    Hits do not reorder the dict. Instead a hit marks the entry as
+    referenced and eviction gives referenced entries a second chance,
+    moving them to the back of the queue (CLOCK). This approximates
+    LRU at the cost of a flag write per hit.
+
+    .. note:: LRUCache may be shared between threads without a lock.
+              Every change to the underlying dict is a single dict
+              operation, which the GIL makes atomic. Concurrent `set`
+              calls can over or under evict by an entry, but cannot
+              corrupt the cache.
     """
 
     def __init__(self, max_size=128):
@@ -27,42 +49,56 @@ class LRUCache:
         :param max_size: The max number of entries in the cache.
         """
         self.max_size = max_size
-        self.queue = OrderedDict()
+        self.queue = {}
 
     def get(self, key):
         """ Get a cache entry
         :param key: the entry's hashable key
         :returns: entry if present else None
         """
-        value = self.queue.get(key, _MISSING)
+        entry = self.queue.get(key, _MISSING)
 
-        if value is not _MISSING:
-            LOG.debug('Cache hit for key: %s; value: %s', key, value)
-            self.queue.move_to_end(key)
-            return value
+        if entry is not _MISSING:
+            LOG.debug('Cache hit for key: %s; value: %s', key, entry.value)
+            entry.referenced = True
+            return entry.value
 
         LOG.debug('Cache miss for key: %s', key)
         return None
 
     def set(self, key, value):
-        """Set a cache entry. If the number of entries exceeds the max_size,
-        then `set` will evict items from the cache until it equal to
-        max_size.
+        """Set a cache entry. If the cache is full, then `set` will evict
+        items from the cache until the new entry fits in max_size.
 
         :param key: the entry's hashable key
         :param value:
         """
 
-        prev = self.queue.pop(key, _MISSING)
+        queue = self.queue
+        prev = queue.pop(key, _MISSING)
 
         LOG.debug('Set key: %s; value: %s; prev: %s', key, value, prev)
-        self.queue[key] = value
-
-        LOG.debug('Cache size: %s', len(self.queue))
-        while len(self.queue) > self.max_size:
-            self.queue.popitem(last=False)
+        LOG.debug('Cache size: %s', len(queue))
+
+        # Make room before inserting so the second chance pass can never
+        # requeue the resident entries behind the new one and evict it.
+        while queue and len(queue) >= self.max_size:
+            try:
+                oldest = next(iter(queue))
+            except (RuntimeError, StopIteration):
+                # Another thread changed the dict between iter and next.
+                continue
+
+            entry = queue.pop(oldest, None)
+            if entry is not None and entry.referenced:
+                # Second chance, requeue it as the newest entry unless
+                # another thread has set the key in the meantime.
+                entry.referenced = False
+                queue.setdefault(oldest, entry)
+
+        queue[key] = _Entry(value)
 
     def clear(self):
         """Clear the cache"""
         LOG.debug('Clear cache, size: %s', len(self.queue))
-        self.queue = OrderedDict()
+        self.queue = {}
@@ -2,11 +2,15 @@
 
 """
 import asyncio
+import functools
 import logging
+import time
+import urllib.parse
+from collections import namedtuple
 
 from .cache import LRUCache
-from .utils import (unique, first, filterdict, immutable,
-                    Pattern, HTML, HTTP, Tag, Response)
+from .utils import (immutable,
+                    Pattern, HTML, HTTP, Response)
 
 __all__ = ('parse_message',)
 
@@ -15,75 +19,178 @@ LOG = logging.getLogger(__name__)
 #: How long to wait for net traffic when fetching titles
 _NET_TIMEOUT = 2.0 # sec
 
-#: _is_title(Element('<title   ./>)) -> True
-_is_title = Tag.is_('title')
+#: How long a failed fetch is remembered before the url is retried
+_NEG_TTL = 30.0 # sec
+
+#: Messages longer than this are scanned off of the event loop so a
+#: single large message does not stall every other connection.
+_SCAN_OFFLOAD_SIZE = 64 * 2 ** 10 # chars
+
+#: Only messages up to this long have their scans memoized, which
+#: bounds the memo to about 512 of these (keys and results).
+_SCAN_MEMO_SIZE = 2 ** 10 # chars
+
+#: Default upper bound on concurrent title fetches. Override per
+#: context with a `fetch_sem` attribute.
+_FETCH_LIMIT = 16
+
+#: The (loop, semaphore) enforcing `_FETCH_LIMIT`. A semaphore belongs
+#: to the loop it first waits on, so it is created on the running loop.
+_fetch_sem = (None, None)
 
 #: In a production setting this should be a caching service.
 #: However, a LRUCache should suffice for demonstrations.
 _cache = LRUCache()
 
+#: Cache entry for a url that failed to fetch. `link` is what to
+#: respond with until the entry expires (monotonic clock).
+_NegativeEntry = namedtuple('_NegativeEntry', ('expires', 'link'))
+
+#: Title fetches currently on the wire, keyed by url, so concurrent
+#: messages with the same url share a single request.
+_inflight = {}
+
 #: Fields of the message response
 Field = immutable('MessageFields', emoticons='emoticons', mentions='mentions', links='links')
 Link = immutable('Link', url='url', title='title')
 
 
-@asyncio.coroutine
-def _format_link(ctx, url):
+def _default_fetch_sem():
+    """Get the default fetch semaphore for the running loop."""
+    global _fetch_sem
+
+    loop = asyncio.get_running_loop()
+    owner, sem = _fetch_sem
+    if owner is not loop:
+        sem = asyncio.Semaphore(_FETCH_LIMIT)
+        _fetch_sem = (loop, sem)
+
+    return sem
+
+
+async def _format_link(ctx, url):
     """Format the url as the dict containing both the url and title::
 
-          >>> loop = asyncio.get_event_loop()
+          >>> loop = asyncio.new_event_loop()
           >>> url = 'http://dillonhicks.io'
-          >>> link = loop.run_until_complete(ctx, url)
+          >>> link = loop.run_until_complete(_format_link(ctx, url))
           >>> print(link)
           {"title": "Dillon Hicks", "url": "http://dillonhicks.io"}
 
     If the url is not in the `msgparse.parser._cache` then this
     function will attempt to fetch and parse the HTML document from
-    the given `url`.
+    the given `url`. Failed fetches and error responses are cached for
+    `_NEG_TTL` seconds so a dead url does not cost a full timeout on
+    every message.
 
     :param ctx: context object containing, at minimum,the asyncio loop
-                and message config values.
+                and message config values. If `ctx.fetch_sem` is set, it
+                is used in place of a `_FETCH_LIMIT` semaphore to bound concurrent fetches.
+                If `ctx.session` is set, it is used in place of the shared
+                `HTTP.session()`.
     :param url: http url
-    :returns: dict containing the url and the title or, on failure, None
+    :returns: dict containing the url and the title or, on failure or
+              an invalid host, None
     """
 
-    if Pattern.http_prefix.search(url) is None:
+    if not url.startswith(('http://', 'https://')):
         url = 'http://' + url
 
+    try:
+        netloc = urllib.parse.urlsplit(url).netloc
+    except ValueError:
+        netloc = ''
+
+    if Pattern.host.match(netloc) is None:
+        # The scan is permissive (http://C++.com), do not bother the
+        # network with hosts that cannot resolve.
+        LOG.debug('Skipping url with an invalid host: %s', url)
+        return None
+
     entry = _cache.get(url)
-    if entry is not None:
+    if isinstance(entry, _NegativeEntry):
+        if entry.expires > time.monotonic():
+            return entry.link
+    elif entry is not None:
         return entry
 
+    fetch = _inflight.get(url)
+    if fetch is None or fetch.get_loop() is not asyncio.get_running_loop():
+        # A fetch from another loop cannot be awaited here, and if that
+        # loop was closed first it is never going to finish.
+        fetch = asyncio.ensure_future(_fetch_link(ctx, url))
+        _inflight[url] = fetch
+        fetch.add_done_callback(functools.partial(_fetch_done, url))
+
+    # Shield the shared fetch so one message timing out does not cancel
+    # it for the others; the HTTP client timeout still bounds it.
+    return await asyncio.shield(fetch)
+
+
+def _fetch_done(url, fetch):
+    """Forget the finished `fetch` unless it was already replaced."""
+    if _inflight.get(url) is fetch:
+        del _inflight[url]
+
+
+async def _fetch_link(ctx, url):
+    """Fetch the document at `url` and cache the resulting link, see
+    `_format_link`.
+    """
+    fetch_sem = getattr(ctx, 'fetch_sem', None)
+    if fetch_sem is None:
+        fetch_sem = _default_fetch_sem()
+
     try:
-        LOG.debug('Fetching url: %s', url)
-        resp = yield from ctx.loop.run_in_executor(None, HTTP.get, url)
+        async with fetch_sem:
+            LOG.debug('Fetching url: %s', url)
+            async with HTTP.get(url, session=getattr(ctx, 'session', None)) as resp:
+                status = resp.status
+                # aiohttp parses and lowercases the mime type once.
+                is_html = resp.content_type == 'text/html'
+
+                title = None
+                if is_html and status == HTTP.ok:
+                    # Lazily and iteratively parse the HTML document as it
+                    # downloads until we find the first title tag, then
+                    # drop the connection rather than read the rest.
+                    chunks = resp.content.iter_chunked(HTML.chunk_size)
+                    elems = HTML.iter(chunks)
+                    async for elem in elems:
+                        if elem.tag == 'title':
+                            title = elem.text
+                            resp.close()
+                            break
+
+                        # Free the subtrees that were not the title.
+                        elem.clear()
+
+                    await elems.aclose()
 
     except Exception as e:
         LOG.exception('An error occurred while fetching %s', url)
 
         # In a production setting, there may be different ways we want
-        # to handle this. Do we add the None value to the cache for a
-        # non 404? do we blacklist the url? etc.
+        # to handle this. Do we blacklist the url? Retry with backoff?
+        # etc. For now, remember the failure for a short while.
+        _cache.set(url, _NegativeEntry(time.monotonic() + _NEG_TTL, None))
         return None
 
-    content_type = resp.headers.get('Content-Type', '')
-
-    if Pattern.content_html.search(content_type) is None \
-            or resp.status_code != HTTP.ok:
+    if not is_html or status != HTTP.ok:
 
-        # Short circuit - we will not try to parse
+        # Short circuit - we did not try to parse
         # mime-type/jpg for a title or error pages.
-        LOG.debug('Skipping processing content of %s', url)
+        LOG.debug('Skipped processing content of %s', url)
 
-        return {
+        link = {
             Link.url: url,
             Link.title: url
         }
 
-    # Lazily and iteratively parse the XHTML document until we find the
-    # first title tag and extract the text from that tag.
-    tags = HTML.iter(resp.content)
-    title = first(tag.text for tag in tags if _is_title(tag))
+        if status != HTTP.ok:
+            _cache.set(url, _NegativeEntry(time.monotonic() + _NEG_TTL, link))
+
+        return link
 
     if title is None:
         title = url
@@ -97,8 +204,61 @@ def _format_link(ctx, url):
     return link
 
 
-@asyncio.coroutine
-def parse_message(ctx, content, max_urls=None):
+async def _format_links(ctx, urls):
+    """Format each of the urls concurrently, see `_format_link`. Waits
+    at most `_NET_TIMEOUT` seconds for all of them.
+
+    :returns: list of the links that were formatted in time, in the
+              order of `urls`
+    """
+    # Offload the link processing to separate coroutines since it might
+    # require making a network call to fetch the title.
+    fs = [asyncio.ensure_future(_format_link(ctx, url)) for url in urls]
+
+    try:
+        results = await asyncio.wait_for(
+            asyncio.gather(*fs, return_exceptions=True), timeout=_NET_TIMEOUT)
+    except asyncio.TimeoutError:
+        # wait_for cancelled the stragglers; keep the links that made it.
+        results = [f.result() for f in fs
+                   if f.done() and not f.cancelled() and f.exception() is None]
+
+    return [r for r in results
+            if r is not None and not isinstance(r, BaseException)]
+
+
+def _scan(content):
+    """Walk the content once, bucketing each special symbol by the name
+    of the group that matched it.
+
+    :returns: tuple of the (mentions, emoticons, urls) tuples of unique
+              symbols in the order they were first observed.
+    """
+    # Every symbol needs at least one of these, and substring tests are
+    # far cheaper than a regex scan.
+    if '@' not in content and '(' not in content \
+            and '.' not in content and '://' not in content:
+        return (), (), ()
+
+    symbols = {'mention': [], 'emoticon': [], 'url': []}
+    for m in Pattern.symbol.finditer(content):
+        kind = m.lastgroup
+        symbols[kind].append(m.group(kind))
+
+    # dict.fromkeys drops duplicates while keeping the first occurrence.
+    return (tuple(dict.fromkeys(symbols['mention'])),
+            tuple(dict.fromkeys(symbols['emoticon'])),
+            tuple(dict.fromkeys(symbols['url'])))
+
+
+#: Chat traffic repeats itself, remember the scans of recent short
+#: messages. Messages over `_SCAN_MEMO_SIZE` bypass this so they are
+#: not pinned in memory and the results are tuples so hits cannot be
+#: mutated.
+_scan_cached = functools.lru_cache(maxsize=512)(_scan)
+
+
+async def parse_message(ctx, content, max_urls=None):
     """Parse a message to extract the list special symbols
     (see: `Field`).
 
@@ -107,7 +267,7 @@ def parse_message(ctx, content, max_urls=None):
     symbol list only contains the unqiue values for that symbol such
     that `len(set(symbols)) == len(symbols)`::
 
-        >>> loop = asyncio.get_event_loop()
+        >>> loop = asyncio.new_event_loop()
         >>> content = '(smile)(smile)(wow)(frown)(frown)(upvote)(smile)'
         >>> result = loop.run_until_complete(parse_message(cxt, content))
         >>> print(result[Field.emoticons] == ['smile', 'wow', 'frown', 'upvote'])
@@ -123,7 +283,9 @@ def parse_message(ctx, content, max_urls=None):
     spent parsing the message since the symbol extraction is on the magnitude
     of >250ms for very large text (1MB).
 
-    :param ctx: context object containing, at minimum, the asyncio loop
+    :param ctx: context object containing, at minimum, the asyncio loop.
+                Messages over `_SCAN_OFFLOAD_SIZE` are scanned in
+                `ctx.scan_pool` if set, else the loop's default executor.
     :param content: Message content
     :type content: str
     :param max_urls: The maximum number of urls to parse or None for unlimited)
@@ -132,47 +294,45 @@ def parse_message(ctx, content, max_urls=None):
     :rtype: str
     :raises TypeError: If content is not str
     """
+    specials = await _parse_message_obj(ctx, content, max_urls=max_urls)
+    return Response.serialize(specials)
+
+
+async def _parse_message_obj(ctx, content, max_urls=None):
+    """Same as `parse_message` but returns the dict of special symbols
+    rather than its serialization, for callers that encode the response
+    themselves.
+    """
     if not isinstance(content, str):
         raise TypeError("Expected type str for content, got %s", type(content))
 
     LOG.debug('Parsing message; length: %s', len(content))
 
-    # Create match generators of each of the special symbol types.
-    mentions = (m.group() for m in Pattern.mention.finditer(content))
-    emoticons = (m.group() for m in Pattern.emoticon.finditer(content))
-    urls = (m.group() for m in Pattern.url.finditer(content))
-
-    # Offload the link processing to separate coroutines since it might
-    # require making a network call to fetch the title.
-    fs = []
-    for count, url in enumerate(unique(urls)):
-        if max_urls is not None and count >= max_urls:
-            LOG.debug('Skipping further urls, content exceeded the max_number'
-                      ' of urls max_urls: %s', max_urls)
-            break
-
-        coro = _format_link(ctx, url)
-        fs.append(asyncio.ensure_future(coro))
-
-    if len(fs) == 0:
-        # asyncio.wait errors on empty lists.
-        links = []
+    if len(content) > _SCAN_OFFLOAD_SIZE:
+        scan_pool = getattr(ctx, 'scan_pool', None)
+        mentions, emoticons, urls = await ctx.loop.run_in_executor(
+            scan_pool, _scan, content)
+    elif len(content) > _SCAN_MEMO_SIZE:
+        mentions, emoticons, urls = _scan(content)
     else:
-        done, pending = yield from asyncio.wait(fs, timeout=_NET_TIMEOUT)
-        links = [f.result() for f in done if f.result() is not None]
-
-        for f in pending:
-            f.cancel()
-
-    # Cohere the special symbols generators into a dict of unique lists
-    # keyed by their symbol name.
-    specials = {
-        Field.mentions: list(unique(mentions)),
-        Field.emoticons: list(unique(emoticons)),
-        Field.links: links,  # links are filtered on url before format
-    }
-
-    # Filter fields with empty lists
-    specials = filterdict(specials)
-
-    return Response.serialize(specials)
+        mentions, emoticons, urls = _scan_cached(content)
+
+    if max_urls is not None and len(urls) > max_urls:
+        LOG.debug('Skipping further urls, content exceeded the max_number'
+                  ' of urls max_urls: %s', max_urls)
+        urls = urls[:max_urls]
+
+    # Most messages have no urls, skip the task machinery for them.
+    links = await _format_links(ctx, urls) if urls else []
+
+    # Cohere the special symbols lists into a dict of unique lists
+    # keyed by their symbol name, omitting the empty ones.
+    specials = {}
+    if mentions:
+        specials[Field.mentions] = list(mentions)
+    if emoticons:
+        specials[Field.emoticons] = list(emoticons)
+    if links:
+        specials[Field.links] = links  # links are filtered on url before format
+
+    return specials
@@ -5,7 +5,8 @@ import os
 import asyncio
 import logging
 
-from .parser import parse_message
+from .parser import _parse_message_obj
+from .utils import Response
 
 __all__ = ('runserver', )
 
@@ -27,14 +28,18 @@ class MessageProtocol(asyncio.Protocol):
         self.transport = transport
 
     def data_received(self, data):
-        message = data.decode()[:self.max_size]
-
-        f = asyncio.ensure_future(parse_message(self.ctx, message, max_urls=self.max_urls))
+        # Truncate before decoding so oversized messages are not decoded
+        # in full. Slicing a memoryview does not copy, and str() decodes
+        # straight from the buffer. The cut may split a multibyte
+        # character, so replace it.
+        message = str(memoryview(data)[:self.max_size], 'utf-8', 'replace')
+
+        coro = _parse_message_obj(self.ctx, message, max_urls=self.max_urls)
+        f = asyncio.ensure_future(coro)
         f.add_done_callback(self.respond)
 
     def respond(self, f):
-        message = f.result() + '\n'
-        self.transport.write(message.encode())
+        self.transport.write(Response.encode(f.result()) + b'\n')
 
 
 def runserver(ctx, max_size, max_urls, path='/tmp/msgparse.sock'):
@@ -1,19 +1,18 @@
 """
 Grab bag of of utilises to assist in parsing and filtering content.
 """
+import asyncio
 import functools
 import re
-from collections import namedtuple
-from io import BytesIO
 
 # 3rd Party Imports
+import aiohttp
 import lxml.etree
-import requests
-from requests.adapters import HTTPAdapter
 
 try:
-    import simplejson as json
+    import orjson
 except ImportError:
+    orjson = None
     import json
 
 __all__ = (
@@ -30,7 +29,11 @@ __all__ = (
 )
 
 _HTTP_TIMEOUT = 2.0 # sec
-_HTTP_RETRIES = 0
+_HTTP_POOL_SIZE = 64
+_HTTP_POOL_SIZE_PER_HOST = 8
+_HTTP_KEEPALIVE = 30.0 # sec
+_HTTP_DNS_TTL = 300 # sec
+_HTML_POOL_SIZE = 16
 
 
 def ident(f):
@@ -74,80 +77,207 @@ def unique(iterable, key=ident):
         yield elem
 
 
+class _Immutable(type):
+    """Metaclass for `immutable` objects, rejects attribute assignment"""
+
+    def __setattr__(cls, name, value):
+        raise AttributeError("can't set attribute {!r} of {}".format(name, cls.__name__))
+
+    def __delattr__(cls, name):
+        raise AttributeError("can't delete attribute {!r} of {}".format(name, cls.__name__))
+
+    def __repr__(cls):
+        attrs = ', '.join('{}={!r}'.format(k, v) for k, v in vars(cls).items()
+                          if not k.startswith('__'))
+        return '{}({})'.format(cls.__name__, attrs)
+
+
 def immutable(clazz_name, **attrs):
-    """Immutable object factory backed by a namedtuple. It is only truly
+    """Immutable object factory backed by a slotted class. It is only truly
     immutable if the attributes are immutable as well. Great for one
     one off instances for objects for which there does not need to be a
     instantiable/mutable class (configs, constants, etc.)
 
-    :param clazz_name: The name given to the namedtuple
+    The attributes are constants on the class itself, so reading them
+    is a plain class attribute lookup and no instance is ever created.
+
+    :param clazz_name: The name given to the class
     :param attrs: The attributes of the immutable object
 
-    :returns: An immutable object instantiated with `**attrs` as attributes.
+    :returns: An immutable object with `**attrs` as attributes.
     """
-    clazz = namedtuple(clazz_name, attrs.keys())
-    return clazz(**attrs)
+    return _Immutable(clazz_name, (), dict(attrs, __slots__=()))
 
 
 class Pattern:
     """Regular expression for parsing or formatting"""
 
-    #: @frank @sally @foo_bar_BAZ123
-    mention = re.compile(r'(?<=[@])[\w]+')
-
-    #: http://what.com, google.com
-    url = re.compile(r"""
-        (http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)
+    #: @frank @sally @foo_bar_BAZ123, (lol) (agree), and http://what.com
+    #: or google.com in a single pass over the content. The name of the
+    #: group that matched is `match.lastgroup`. Matches do not overlap,
+    #: so bob@example.com is only a url and @bob.com is only a mention.
+    #: The @ and ( are matched, rather than looked behind for, since
+    #: literal prefixes fail faster at each position.
+    #:
+    #: The url characters are a single class (not an alternation per
+    #: character) and bare domains must start a whitespace delimited
+    #: token, otherwise `\S+` is retried from every offset of a long
+    #: token and the scan goes quadratic.
+    symbol = re.compile(r"""
+        @(?P<mention>[\w]+)
         | # or
-        (\S+[.][a-zA-Z]{2,6})""", re.VERBOSE)
-
-    #: (lol) (agree)
-    emoticon = re.compile(r'(?<=[(])[a-zA-Z0-9]{1,15}(?=[)])')
+        [(](?P<emoticon>[a-zA-Z0-9]{1,15})(?=[)])
+        | # or
+        (?P<url>http[s]?://[a-zA-Z0-9$-_@.&+!*(),%]+
+                | (?<!\S)\S+[.][a-zA-Z]{2,6})""", re.VERBOSE)
+
+    #: The host[:port] of a url: dns labels, or a bracketed ipv6 address.
+    #: Labels may hold underscores (my_site.example.com) and the name may
+    #: be fully qualified (example.com.), as at the end of a sentence.
+    host = re.compile(r"""
+        (?:[a-zA-Z0-9_](?:[a-zA-Z0-9_-]*[a-zA-Z0-9_])?[.])*
+        [a-zA-Z0-9_](?:[a-zA-Z0-9_-]*[a-zA-Z0-9_])?[.]?
+        (?::[0-9]+)?$
+        | # or
+        \[[0-9a-fA-F:.]+\](?::[0-9]+)?$""", re.VERBOSE)
 
     #: two or more whitespace symbols
     multi_ws = re.compile(r'\s\s+')
 
-    #: http:// or https:// prefix
-    http_prefix = re.compile(r'^http[s]?://')
-
-    #: case insensitive pattern for
-    content_html = re.compile(r'text/html', re.I)
-
 
 class Response:
     #: Abstraction wrapper to allow for a single definition : of how
     #: responses are serialized. In this case, we use the json pretty
-    #: print style (4 spaces per level of nesting).
-    serialize = functools.partial(json.dumps, indent=4, separators=(',', ': '))
+    #: print style (2 spaces per level of nesting) as utf-8 bytes.
+    if orjson is not None:
+        encode = functools.partial(orjson.dumps, option=orjson.OPT_INDENT_2)
+    else:
+        @staticmethod
+        def encode(obj):
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode()
+
+    @staticmethod
+    def serialize(obj):
+        """`encode` as a str"""
+        return Response.encode(obj).decode()
 
 
 class HTTP:
     """HTTP constants and verb functions"""
-    _session = requests.Session()
-    _session.mount('http://', HTTPAdapter(max_retries=0))
-    _session.mount('https://', HTTPAdapter(max_retries=0))
+
+    #: The (loop, session) shared by title fetches. A session belongs to
+    #: the loop it was created on, so it is created on the running loop.
+    _session = (None, None)
 
     #: The good status code for HTTP responses
     ok = 200
 
-     #: Asyncio friendly wrapper for requests.get with a timeout
-    get = functools.partial(_session.get, timeout=_HTTP_TIMEOUT)
+    @staticmethod
+    def new_session():
+        """Create an aiohttp session configured for title fetches. Must be
+        called from a coroutine running on the event loop the session
+        should be bound to.
+        """
+        # Keep idle connections and resolved hosts around so repeat
+        # fetches skip DNS and the TCP/TLS handshakes.
+        connector = aiohttp.TCPConnector(
+            limit=_HTTP_POOL_SIZE,
+            limit_per_host=_HTTP_POOL_SIZE_PER_HOST,
+            keepalive_timeout=_HTTP_KEEPALIVE,
+            ttl_dns_cache=_HTTP_DNS_TTL)
+        timeout = aiohttp.ClientTimeout(total=_HTTP_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    @classmethod
+    def session(cls):
+        """Get the shared aiohttp session for the running loop, creating
+        it with `new_session` if needed.
+        """
+        loop = asyncio.get_running_loop()
+        owner, session = cls._session
+        if owner is not loop or session.closed:
+            session = cls.new_session()
+            cls._session = (loop, session)
+
+        return session
+
+    @classmethod
+    def get(cls, url, session=None):
+        """GET `url` with `session`, or the shared session if None. Use as
+        an async context manager so the connection is released back to
+        the pool::
+
+            async with HTTP.get(url) as resp:
+                content = await resp.read()
+        """
+        if session is None:
+            session = cls.session()
+
+        return session.get(url)
+
+    @classmethod
+    async def close(cls):
+        """Close the shared session if one was created"""
+        owner, session = cls._session
+        if session is not None:
+            await session.close()
+            cls._session = (None, None)
 
 
 class HTML:
     """Utilities for interacting with HTML documents"""
 
+    #: Bytes of the document handed to the parser at a time
+    chunk_size = 4 * 2 ** 10
+
+    #: Idle parsers kept for reuse by `iter`. A parser is popped while
+    #: in use, so concurrent documents never share one.
+    _parsers = []
+
     @staticmethod
-    def iter(content):
+    async def iter(chunks):
         """Generates each element in the DOM of the HTML one element at a
-        time. Will recover on failure. Unparsable documents become a
-        single paragraph element containing the text of the content.
-        """
+        time as the chunks of the document arrive, so callers can stop
+        reading once they have found what they need. Will recover on
+        failure. Unparsable documents become a single paragraph element
+        containing the text of the content.
 
-        context = lxml.etree.iterparse(BytesIO(content), recover=True, html=True)
+        Callers that stop early should `aclose()` the generator so its
+        parser is returned to the pool straight away.
 
-        for action, elem in context:
-            yield elem
+        :param chunks: async iterable of the document's bytes
+        """
+        if HTML._parsers:
+            parser = HTML._parsers.pop()
+        else:
+            parser = lxml.etree.HTMLPullParser(recover=True, remove_blank_text=True)
+
+        closed = False
+        try:
+            async for chunk in chunks:
+                parser.feed(chunk)
+                for action, elem in parser.read_events():
+                    yield elem
+
+            closed = True
+            parser.close()
+            for action, elem in parser.read_events():
+                yield elem
+
+        finally:
+            # Reset the parser state and drop pending events before it is
+            # reused. Closing a partial (or empty) document may complain.
+            if not closed:
+                try:
+                    parser.close()
+                except lxml.etree.XMLSyntaxError:
+                    pass
+
+            for _ in parser.read_events():
+                pass
+
+            if len(HTML._parsers) < _HTML_POOL_SIZE:
+                HTML._parsers.append(parser)
 
 
 class Tag:
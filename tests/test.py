@@ -1,35 +1,215 @@
 import asyncio
+import collections
 import logging
+import threading
 import unittest
+import unittest.mock
+
+import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
 
 try:
-    import simplejson as json
+    from orjson import loads
 except ImportError:
-    import json
+    try:
+        from simplejson import loads
+    except ImportError:
+        from json import loads
 
-from msgparse.utils import immutable
-from msgparse.parser import Field, Link, parse_message
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from msgparse.cache import LRUCache
+from msgparse.utils import immutable, HTTP, Response
+from msgparse import parser
+from msgparse.parser import Field, Link, parse_message, _format_link, _parse_message_obj
+from msgparse.server import MessageProtocol
 
 LOG = logging.getLogger(__name__)
 MiB = 2 ** 20
 
+#: Upper bound on concurrent title fetches across the tests
+FETCH_LIMIT = 16
+
+#: Url limit for the large message test, the cli default
+MAX_URLS = 5
+
+#: Mentions expected from the cmcg4 message
+_MENTIONS_BOB_JOHN = ('bob', 'john')
+
+#: Titles served by `_FakeSession`; any other url is unreachable.
+_TITLES = {
+    'http://google.com': 'Google',
+    # The first MAX_URLS urls of monster.json
+    'http://youtube.com': 'YouTube',
+    'http://twitter.com': 'Twitter',
+    'http://yahoo.com': 'Yahoo',
+    'http://wikipedia.org': 'Wikipedia',
+    'http://bitbucket.org': 'Bitbucket',
+    'http://dillonhicks.io': 'Dillon Hicks',
+    'http://dillonhicks.io/index.html': 'Dillon Hicks',
+    'http://www.nbcolympics.com': 'NBC Olympics',
+    'http://www.nbcolympics.com.': 'NBC Olympics',
+    'http://my_site.example.com': 'My Site',
+    # Served, but the host is invalid so it must never be fetched
+    'http://C++.com': 'C++',
+    'https://twitter.com/jdorfman/status/430511497475670016': (
+        'Justin Dorfman on Twitter: "nice @littlebigdetail from '
+        '@HipChat (shows hex colors when pasted in chat). '
+        'http://t.co/7cI6Gjy5pq"'),
+}
+
+
+class _FakeContent:
+
+    def __init__(self, body):
+        self._body = body
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self._body), n):
+            yield self._body[i:i + n]
+
+
+class _FakeResponse:
+    """Just enough of `aiohttp.ClientResponse` for `_format_link`."""
+    content_type = 'text/html'
+
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+        self.status = session.status
+
+    async def __aenter__(self):
+        session = self.session
+        session.active += 1
+        session.peak = max(session.peak, session.active)
+
+        if session.delay:
+            await asyncio.sleep(session.delay)
+
+        if self.url not in session.titles:
+            session.active -= 1
+            raise aiohttp.ClientConnectionError('Cannot connect to %s' % self.url)
+
+        html = '<html><head><title>{}</title></head><body></body></html>'
+        self.content = _FakeContent(html.format(session.titles[self.url]).encode())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.session.active -= 1
+
+    def close(self):
+        pass
+
+
+class _FakeSession:
+    """Stands in for the aiohttp session so the tests do not reach out
+    to the network. Serves `titles` (default `_TITLES`) with `status`,
+    each after `delay` seconds. `fetched` counts the requests made for
+    each url and `peak` is the most requests that were open at once."""
+
+    def __init__(self, titles=_TITLES, delay=0, status=HTTP.ok):
+        self.titles = titles
+        self.delay = delay
+        self.status = status
+        self.fetched = collections.Counter()
+        self.active = 0
+        self.peak = 0
+
+    def get(self, url):
+        self.fetched[url] += 1
+        return _FakeResponse(url, self)
+
+    async def close(self):
+        pass
+
+
+class _FakeTransport:
+    """Resolves `written` with the first write of a protocol."""
+
+    def __init__(self):
+        self.written = asyncio.get_running_loop().create_future()
+
+    def write(self, data):
+        self.written.set_result(data)
+
+
+async def _serve_title(title):
+    """Start a local HTTP server whose pages are all titled `title`."""
+    async def page(request):
+        html = '<html><head><title>{}</title></head><body></body></html>'
+        return aiohttp.web.Response(text=html.format(title), content_type='text/html')
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/', page)
+    server = aiohttp.test_utils.TestServer(app, host='127.0.0.1')
+    await server.start_server()
+    return server
+
+
+def _dbg(obj):
+    """Log `obj`, skipping the LogRecord entirely unless debug is on."""
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug('%s', obj)
+
+
+async def _fetch_resources():
+    """The fetch semaphore must be created on the loop that uses it."""
+    return _FakeSession(), asyncio.Semaphore(FETCH_LIMIT)
+
 
 class MessageParsingTests(unittest.TestCase):
     ctx = None
 
+    _EXPECTED_CMCG4_LINKS = (
+        {
+            Link.url: 'https://twitter.com/jdorfman/status/430511497475670016',
+            Link.title: ('Justin Dorfman on Twitter: "nice @littlebigdetail from '
+                         '@HipChat (shows hex colors when pasted in chat). '
+                         'http://t.co/7cI6Gjy5pq"')
+        },
+    )
+
     @staticmethod
     def setUpClass():
-        MessageParsingTests.ctx = immutable('Context', loop=asyncio.get_event_loop())
+        # One loop and one (fake) HTTP session for every test in the
+        # class. Fetches run concurrently but bounded.
+        loop_factory = uvloop.new_event_loop if uvloop is not None else None
+        runner = asyncio.Runner(loop_factory=loop_factory)
+        session, fetch_sem = runner.run(_fetch_resources())
+        MessageParsingTests.ctx = immutable('Context', runner=runner, loop=runner.get_loop(),
+                                            session=session, fetch_sem=fetch_sem)
 
     @staticmethod
     def tearDownClass():
-        MessageParsingTests.ctx.loop.close()
+        MessageParsingTests.ctx.runner.run(MessageParsingTests.ctx.session.close())
+        MessageParsingTests.ctx.runner.close()
+
+    def _parse(self, content, **kwargs):
+        """Run `_parse_message_obj` to completion on the class runner."""
+        return self.ctx.runner.run(_parse_message_obj(self.ctx, content, **kwargs))
+
+    def _session_ctx(self, session):
+        """The class context, but fetching through `session`."""
+        return immutable('Context', runner=self.ctx.runner, loop=self.ctx.loop,
+                         session=session, fetch_sem=self.ctx.fetch_sem)
+
+    def _parse_many(self, inputs):
+        """Parse independent (content, kwargs) inputs concurrently with
+        a single trip through the loop."""
+        async def parse_all():
+            return await asyncio.gather(*(_parse_message_obj(self.ctx, content, **kw)
+                                          for content, kw in inputs))
+
+        return self.ctx.runner.run(parse_all())
 
     def test_emoticon(self):
         emoticon = 'lolwut'
         content = '({})'.format(emoticon)
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(content)
 
         assert len(result[Field.emoticons]) == 1
         assert result[Field.emoticons][0] == emoticon
@@ -37,16 +217,14 @@ class MessageParsingTests(unittest.TestCase):
         assert Field.mentions not in result
 
         emoticon = '(123abc)'
-        parser = parse_message(self.ctx, emoticon)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(emoticon)
         assert len(result[Field.emoticons]) == 1
 
     def test_mention(self):
 
         mention = 'dillon'
         content = '@{}'.format(mention)
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(content)
 
         assert len(result[Field.mentions]) == 1
         assert result[Field.mentions][0] == mention
@@ -56,9 +234,8 @@ class MessageParsingTests(unittest.TestCase):
     def test_link(self):
 
         url = 'http://google.com'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(url)
+        _dbg(result)
 
         assert len(result[Field.links]) == 1
         assert result[Field.links][0][Link.url] == url
@@ -68,32 +245,35 @@ class MessageParsingTests(unittest.TestCase):
 
         # Ensure full uris work and not just domains
         url = 'http://dillonhicks.io/index.html'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(url)
+        _dbg(result)
         assert len(result[Field.links]) == 1
 
         # This case IS NOT a failure case since the url regex still
         # matches google.com
         url = 'http:// google.com'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(url)
+        _dbg(result)
         assert len(result[Field.links]) == 1
 
+    def test_serialized(self):
+        content = '@bob (success)'
+        parser = parse_message(self.ctx, content)
+        result = loads(self.ctx.runner.run(parser))
+
+        assert result == {Field.mentions: ['bob'], Field.emoticons: ['success']}
+
     def test_empty(self):
         content = ''
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(content)
+        _dbg(result)
         assert len(result) == 0
 
     @unittest.expectedFailure
     def test_not_str(self):
         content = None
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(content)
+        _dbg(result)
 
 
     def test_no_specials(self):
@@ -102,129 +282,272 @@ class MessageParsingTests(unittest.TestCase):
             'assimilated. As a drone, you will have no need of mentions or '
             'emoticons for we are all hyperlinked.')
 
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(content)
+        _dbg(result)
         assert len(result) == 0
 
     def test_url_limit(self):
         max_urls = 1
         content = 'http://bitbucket.org http://google.com http://dillonhicks.io'
-        parser = parse_message(self.ctx, content, max_urls=max_urls)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        result = self._parse(content, max_urls=max_urls)
+        _dbg(result)
         assert len(result[Field.links]) == max_urls
 
     @unittest.skip("Disabled by default")
     def test_big(self):
-        with open('tests/monster.json', 'r') as inf:
-            monster = json.load(inf)
+        with open('tests/monster.json', 'rb') as inf:
+            monster = loads(inf.read())
 
-        parser = parse_message(self.ctx, monster['content'])
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(monster['content'], max_urls=MAX_URLS)
 
-        assert len(result[Field.links]) == self.ctx.message.max_urls
+        assert len(result[Field.links]) == MAX_URLS
         assert len(result[Field.emoticons]) == monster['emoticons']
         assert len(result[Field.mentions]) == monster['mentions']
 
-    def test_bad_links(self):
-        """Test for bad links. In an idea world we would
-        have mock for HTTP.get that would not reach out
-        to the network."""
-        url = 'http://C++.com'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        url = 'lol.c om'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        url = 'htt://lol._org'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        url = ''
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+    def test_long_token(self):
+        """A single 1MiB token with a dot, but no url, used to backtrack
+        from every offset (quadratic) and would effectively hang."""
+        content = 'a' * MiB + '.'
+        result = self._parse(content)
         assert len(result) == 0
 
-        url = 'https://wubba.dubbalublub'
-        parser = parse_message(self.ctx, url)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+    def test_bad_links(self):
+        """Test for bad links. Unknown hosts are unreachable
+        through `_FakeSession`."""
+        results = self._parse_many([
+            ('http://C++.com', {}),
+            ('lol.c om', {}),
+            ('htt://lol._org', {}),
+            ('', {}),
+            ('https://wubba.dubbalublub', {}),
+        ])
+
+        for result in results:
+            _dbg(result)
+            assert len(result) == 0
+
+    def test_invalid_host(self):
+        """Hosts that cannot resolve are skipped without a fetch, even
+        when the session would serve them."""
+        url = 'http://C++.com'
+        result = self._parse(url)
+        _dbg(result)
         assert len(result) == 0
+        assert self.ctx.session.fetched[url] == 0
+
+    def test_host_forms(self):
+        # Trailing period from the end of a sentence
+        content = 'Olympics are starting soon, see http://www.nbcolympics.com.'
+        result = self._parse(content)
+        _dbg(result)
+        assert result[Field.links] == [{Link.url: 'http://www.nbcolympics.com.',
+                                        Link.title: 'NBC Olympics'}]
+
+        # Underscores in a label
+        url = 'http://my_site.example.com'
+        result = self._parse(url)
+        _dbg(result)
+        assert result[Field.links] == [{Link.url: url, Link.title: 'My Site'}]
+
+    def test_default_fetch_sem(self):
+        """Without `ctx.fetch_sem` a default semaphore is made for each
+        loop, so contended fetches work on more than one loop. Likewise,
+        without `ctx.session` each loop gets its own shared session."""
+        for run in range(2):
+            urls = ['http://run%d.example.com/%d' % (run, i) for i in range(2 * FETCH_LIMIT)]
+            session = _FakeSession(titles=dict.fromkeys(urls, 'Example'), delay=0.001)
+
+            async def parse_all():
+                loop = asyncio.get_running_loop()
+                ctx = immutable('Context', loop=loop, session=session)
+                results = await asyncio.gather(*(_parse_message_obj(ctx, url) for url in urls))
+
+                # The real HTTP.session() path, left open between runs
+                server = await _serve_title('Local')
+                try:
+                    local = await _parse_message_obj(immutable('Context', loop=loop),
+                                                     str(server.make_url('/')))
+                finally:
+                    await server.close()
+                    if run == 1:
+                        await HTTP.close()
+
+                return results, local
+
+            results, local = asyncio.run(parse_all())
+            assert all(len(r[Field.links]) == 1 for r in results)
+            assert local[Field.links][0][Link.title] == 'Local'
+
+    def test_fetch_sem_bound(self):
+        """Concurrent fetches never exceed `ctx.fetch_sem`, or the
+        `_FETCH_LIMIT` default without one."""
+
+        def peak(name, limit=None):
+            urls = ['http://%s.example.com/%d' % (name, i) for i in range(4 * parser._FETCH_LIMIT)]
+            session = _FakeSession(titles=dict.fromkeys(urls, 'Bound'), delay=0.001)
+
+            async def fetch_all():
+                loop = asyncio.get_running_loop()
+                if limit is None:
+                    ctx = immutable('Context', loop=loop, session=session)
+                else:
+                    ctx = immutable('Context', loop=loop, session=session,
+                                    fetch_sem=asyncio.Semaphore(limit))
+
+                return await asyncio.gather(*(_format_link(ctx, url) for url in urls))
+
+            links = self.ctx.runner.run(fetch_all())
+            assert all(link is not None for link in links)
+            return session.peak
+
+        assert 1 < peak('bounded', limit=3) <= 3
+        assert 1 < peak('default') <= parser._FETCH_LIMIT
+
+    def test_coalesced_fetch(self):
+        """Concurrent messages with the same url share a single fetch."""
+        url = 'http://coalesced.example.com'
+        session = _FakeSession(titles={url: 'Coalesced'}, delay=0.01)
+        ctx = self._session_ctx(session)
+
+        async def parse_all():
+            return await asyncio.gather(*(_parse_message_obj(ctx, url) for _ in range(8)))
+
+        results = self.ctx.runner.run(parse_all())
+        for result in results:
+            assert result[Field.links] == [{Link.url: url, Link.title: 'Coalesced'}]
+
+        assert session.fetched[url] == 1
+        assert url not in parser._inflight
+
+    def test_coalesced_fetch_cancelled(self):
+        """A shared fetch outlives the waiter that started it."""
+        url = 'http://cancelled.example.com'
+        session = _FakeSession(titles={url: 'Cancelled'}, delay=0.01)
+        ctx = self._session_ctx(session)
+
+        async def race():
+            first = asyncio.ensure_future(_format_link(ctx, url))
+            second = asyncio.ensure_future(_format_link(ctx, url))
+
+            # Let both join the fetch, then time out the one that made it.
+            await asyncio.sleep(0)
+            first.cancel()
+            return first, await second
+
+        first, link = self.ctx.runner.run(race())
+        assert first.cancelled()
+        assert link == {Link.url: url, Link.title: 'Cancelled'}
+        assert session.fetched[url] == 1
+
+    def test_inflight_other_loop(self):
+        """A fetch left pending on a closed loop is replaced, rather than
+        shared, on the next loop."""
+        url = 'http://abandoned.example.com'
+        titles = {url: 'Abandoned'}
+
+        loop = asyncio.new_event_loop()
+        ctx = immutable('Context', loop=loop, session=_FakeSession(titles=titles, delay=60))
+        with self.assertRaises(asyncio.TimeoutError):
+            loop.run_until_complete(asyncio.wait_for(_format_link(ctx, url), 0.01))
+        loop.close()
+
+        # The shielded fetch outlived its waiter, and now its loop.
+        assert url in parser._inflight
+
+        session = _FakeSession(titles=titles)
+        link = self.ctx.runner.run(_format_link(self._session_ctx(session), url))
+        assert link == {Link.url: url, Link.title: 'Abandoned'}
+        assert session.fetched[url] == 1
+        assert url not in parser._inflight
+
+    def test_negative_cache(self):
+        """Dead urls and error pages are fetched once, not per message."""
+        url = 'http://dead.example.com'
+        session = _FakeSession(titles={})
+        ctx = self._session_ctx(session)
+        for _ in range(3):
+            result = self.ctx.runner.run(_parse_message_obj(ctx, url))
+            assert len(result) == 0
+
+        assert session.fetched[url] == 1
+
+        url = 'http://missing.example.com'
+        session = _FakeSession(titles={url: 'Not Found'}, status=404)
+        ctx = self._session_ctx(session)
+        for _ in range(3):
+            result = self.ctx.runner.run(_parse_message_obj(ctx, url))
+            assert result[Field.links] == [{Link.url: url, Link.title: url}]
+
+        assert session.fetched[url] == 1
+
+    def test_negative_cache_expires(self):
+        url = 'http://expired.example.com'
+        session = _FakeSession(titles={})
+        ctx = self._session_ctx(session)
+        with unittest.mock.patch.object(parser, '_NEG_TTL', -1.0):
+            for _ in range(2):
+                result = self.ctx.runner.run(_parse_message_obj(ctx, url))
+                assert len(result) == 0
+
+        assert session.fetched[url] == 2
+
+    def test_server_truncate(self):
+        """The server cuts messages at `max_size` bytes, even mid
+        character, and writes the encoded response."""
+        content = '@josé (coffee)'.encode()
+        max_size = content.index('é'.encode()) + 1
+
+        async def receive():
+            transport = _FakeTransport()
+            protocol = MessageProtocol(self.ctx, max_size=max_size, max_urls=MAX_URLS)
+            protocol.connection_made(transport)
+            protocol.data_received(content)
+            return await transport.written
+
+        written = self.ctx.runner.run(receive())
+        _dbg(written)
+        assert written == Response.encode({Field.mentions: ['jos']}) + b'\n'
 
     def test_bad_emoticons(self):
-
-        # Too long
-        emoticon = '(inagalaxyfarfarawaytherewasoneemoticontorulethemall)'
-        parser = parse_message(self.ctx, emoticon)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        # Too short
-        emoticon = '()'
-        parser = parse_message(self.ctx, emoticon)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        # malformed - notalphanum
-        emoticon = '(mal forma)'
-        parser = parse_message(self.ctx, emoticon)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        # malformed - notalphanum
-        emoticon = '(one+two)'
-        parser = parse_message(self.ctx, emoticon)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
+        results = self._parse_many([
+            # Too long
+            ('(inagalaxyfarfarawaytherewasoneemoticontorulethemall)', {}),
+            # Too short
+            ('()', {}),
+            # malformed - notalphanum
+            ('(mal forma)', {}),
+            # malformed - notalphanum
+            ('(one+two)', {}),
+        ])
+
+        for result in results:
+            _dbg(result)
+            assert len(result) == 0
 
     def test_bad_mentions(self):
-        # Too long
-        mention = '@'
-        parser = parse_message(self.ctx, mention)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        # Too short
-        mention = '@bob+loblaw'
-        parser = parse_message(self.ctx, mention)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
+        results = self._parse_many([
+            # Too short
+            ('@', {}),
+            # malformed - notalphanum
+            ('@+1', {}),
+            # malformed - allow _ but not -
+            ('@-there-', {}),
+            # Stops at the first non word character
+            ('@bob+loblaw', {}),
+        ])
+
+        *bad, result = results
+        for r in bad:
+            _dbg(r)
+            assert len(r) == 0
+
+        _dbg(result)
         assert len(result[Field.mentions])== 1
         assert result[Field.mentions][0] == 'bob'
 
-        # malformed - notalphanum
-        mention = '@+1'
-        parser = parse_message(self.ctx, mention)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
-        # malformed - allow _ but not -
-        mention = '@-there-'
-        parser = parse_message(self.ctx, mention)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-        LOG.debug('%s', result)
-        assert len(result) == 0
-
     def test_cmcg1(self):
         content = '@chris you around?'
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(content)
 
         assert len(result[Field.mentions]) == 1
         assert result[Field.mentions] == ['chris']
@@ -232,16 +555,14 @@ class MessageParsingTests(unittest.TestCase):
     def test_cmcg2(self):
         content = "Good morning! (megusta) (coffee) (coffee) (coffee)"
 
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(content)
 
         assert len(result[Field.emoticons]) == 2
         assert result[Field.emoticons] == ['megusta', 'coffee']
 
     def test_cmcg3(self):
         content = "Olympics are starting soon; http://www.nbcolympics.com"
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
+        result = self._parse(content)
 
         assert len(result[Field.links]) == 1
         assert result[Field.links][0][Link.url] == 'http://www.nbcolympics.com'
@@ -251,18 +572,86 @@ class MessageParsingTests(unittest.TestCase):
         content = ('@bob @john (success) such a cool feature; '
                   'https://twitter.com/jdorfman/status/430511497475670016')
 
-        parser = parse_message(self.ctx, content)
-        result = json.loads(self.ctx.loop.run_until_complete(parser))
-
-        links = [
-            {
-                Link.url: 'https://twitter.com/jdorfman/status/430511497475670016',
-                Link.title: ('Justin Dorfman on Twitter: "nice @littlebigdetail from '
-                          '@HipChat (shows hex colors when pasted in chat). '
-                          'http://t.co/7cI6Gjy5pq"')
-            }
-        ]
-
-        assert result[Field.mentions] == ['bob', 'john']
+        result = self._parse(content)
+
+        assert tuple(result[Field.mentions]) == _MENTIONS_BOB_JOHN
         assert result[Field.emoticons] == ['success']
-        assert result[Field.links] == links
+        assert tuple(result[Field.links]) == self._EXPECTED_CMCG4_LINKS
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_miss(self):
+        cache = LRUCache(max_size=2)
+        assert cache.get('a') is None
+
+    def test_evict_oldest(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('c', 3)
+
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+        assert cache.get('c') == 3
+
+    def test_get_refreshes(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+
+        cache.set('c', 3)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+
+    def test_second_chance_expires(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+
+        # 'a' is requeued once, but not read again so it is evicted
+        # when it next becomes the oldest entry.
+        cache.set('c', 3)
+        cache.set('d', 4)
+        cache.set('e', 5)
+        assert cache.get('a') is None
+        assert cache.get('d') == 4
+        assert cache.get('e') == 5
+
+    def test_set_after_all_hit(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        assert cache.get('b') == 2
+
+        # Every resident entry has a second chance, but the new entry
+        # must still be the one that stays.
+        cache.set('c', 3)
+        assert cache.get('c') == 3
+        assert len(cache.queue) == 2
+
+    def test_threads(self):
+        max_size = 16
+        cache = LRUCache(max_size=max_size)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(10000):
+                    key = (offset + i) % 64
+                    if cache.get(key) is None:
+                        cache.set(key, i)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert len(cache.queue) <= max_size + len(threads)